@@ -0,0 +1,36 @@
+/*
+ * Pack RGB888 pixels into big-endian RGB565, as the st7789 display expects them on the wire.
+ * Loaded by pistats.py through ctypes, which falls back to numpy when this library is missing.
+ *
+ * Build it next to pistats.py with:
+ *   gcc -O3 -shared -fPIC -o pack565.so pack565.c                # 64-bit Raspberry Pi OS
+ *   gcc -O3 -mfpu=neon -shared -fPIC -o pack565.so pack565.c     # 32-bit Raspberry Pi OS
+ */
+#include <stdint.h>
+
+#ifdef __ARM_NEON
+#include <arm_neon.h>
+#endif
+
+
+void pack565 (const uint8_t *rgb, uint8_t *out, int npixels)
+{
+    int i = 0;
+
+#ifdef __ARM_NEON
+    /* 16 pixels at a time: de-interleave R, G, B, then interleave the high and low bytes */
+    for (; i + 16 <= npixels; i += 16, rgb += 48, out += 32) {
+        uint8x16x3_t px = vld3q_u8(rgb);
+        uint8x16x2_t packed;
+        packed.val[0] = vorrq_u8(vandq_u8(px.val[0], vdupq_n_u8(0xF8)), vshrq_n_u8(px.val[1], 5));
+        packed.val[1] = vorrq_u8(vshlq_n_u8(vandq_u8(px.val[1], vdupq_n_u8(0x1C)), 3),
+                                 vshrq_n_u8(px.val[2], 3));
+        vst2q_u8(out, packed);
+    }
+#endif
+
+    for (; i < npixels; i++, rgb += 3, out += 2) {
+        out[0] = (rgb[0] & 0xF8) | (rgb[1] >> 5);
+        out[1] = ((rgb[1] & 0x1C) << 3) | (rgb[2] >> 3);
+    }
+}
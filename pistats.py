@@ -5,27 +5,96 @@
 #     https://learn.adafruit.com/adafruit-mini-pitft-135x240-color-tft-add-on-for-raspberry-pi/python-stats
 #   Last Modified: Add reboot/shutdown logic.
 #
+# The SPI clock is the biggest lever on how long a frame push takes: doubling it roughly
+# halves the push. The Pi divides its core clock by an even number to get the SPI clock,
+# so the real rate is at or below the request (a 500 MHz core turns both 64 and 80 MHz into
+# 62.5 MHz, while 100 MHz gives 83.3 MHz). Faster clocks need short, clean wiring: if the
+# display shows garbage, lower it by setting PISTATS_BAUD (in Hz, up to 125 MHz) in the
+# environment. The kernel quietly clamps a clock it cannot do, so nothing here can tell
+# whether a given clock works on a given display: only looking at it can.
+#
 import board
+import ctypes
 import digitalio
+import math
 import os
-import subprocess
+import select
+import signal
+import socket
+import sys
 import time
 
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from adafruit_rgb_display.rgb import color565
 import adafruit_rgb_display.st7789 as st7789
 
+# Optional libgpiod (v1) bindings for edge-triggered buttons, else the buttons are polled:
+try:
+    import gpiod
+    GPIOD_BOTH_EDGES = gpiod.LINE_REQ_EV_BOTH_EDGES
+except (ImportError, AttributeError):
+    gpiod = None
+
 
 ROTATION = 180                              # rotation angle for top-to-bottom text
 
+DEFAULT_BAUDRATE = 80000000                 # SPI clock (in Hz), unless PISTATS_BAUD says otherwise
+MAX_BAUDRATE = 125000000                    # fastest SPI clock accepted from PISTATS_BAUD
+
+# The display rotates in hardware: for each supported rotation, the st7789 memory access
+# control (MADCTL) flags and the resulting row offset of the 240x240 panel in its 240x320 RAM.
+MADCTL = 0x36
+MADCTL_ROTATIONS = { 0: (0xC0, 80), 180: (0x00, 0) }
+
+WIDTH = 240                                 # width of display
+HEIGHT = 240                                # height of display
+BLACK_IMAGE = Image.new('RGB', (WIDTH, HEIGHT), (0, 0, 0))  # pasted to clear the drawing area
+
 COLORS = { "pink": "#FF9999", "aqua": "#00FFFF", "green": "#00FF00",
            "white": "#FFFFFF", "yellow": "#FFFF00", "magenta": "#FF00FF",
            "blue": "#0000FF", "red": "#FF0000" }
+FILL_COLORS = list(COLORS.values())         # colors to cycle through for the stat lines
+
+# Button status line and its color, by button state: (button A pressed << 1) | button B pressed
+BUTTON_LABELS = { 0b00: ("Btns: both OFF", COLORS['red']),
+                  0b01: ("Btns: A=OFF, B=ON", COLORS['white']),
+                  0b10: ("Btns: A=ON, B=OFF", COLORS['white']),
+                  0b11: ("Btns: both ON", COLORS['green']) }
+BOTH_BUTTONS = 0b11                         # button state which opens the restart menu
 
 FONT = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', 24)
 TEXT_HEIGHT = FONT.getsize('T')[1]
 BIG_FONT = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', 28)
 BIG_TEXT_HEIGHT = BIG_FONT.getsize('T')[1]
+BIG_LINE_HEIGHT = BIG_FONT.getsize('Tg')[1]  # text height including descenders
+
+# Optional C packer of RGB888 into RGB565 (see pack565.c), else numpy does the packing:
+try:
+    PACK565 = ctypes.CDLL(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'pack565.so')).pack565
+    PACK565.argtypes = (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int)
+    PACK565.restype = None
+except OSError:
+    PACK565 = None
+
+POLL_TIME = 0.03                            # time (in seconds) between button checks while waiting
+GPIO_CHIP = '/dev/gpiochip0'                # GPIO chip with the button lines, when using libgpiod
+BUTTON_A_LINE = 23                          # GPIO line of button A (board.D23)
+BUTTON_B_LINE = 24                          # GPIO line of button B (board.D24)
+
+HOSTNAME_LINE = ''                          # hostname display string, set once at startup
+IP_LINE = ''                                # IP address display string, set once at startup
+
+SPIDEV_BUFSIZ_FILE = '/sys/module/spidev/parameters/bufsiz'  # kernel limit on one SPI transfer
+
+GIGABYTE = 1024 * 1024 * 1024               # units for disk sizes, as shown by 'df -h'
+STAT_CACHE = {}                             # last (timestamp, string) read for each statistic, by name
+STAT_FILES = {}                             # open /proc and /sys files, by path
+CPU_TIMES = (0, 0)                          # (busy, total) CPU time counters at the last CPU reading
+
+GLYPH_CHARS = '0123456789:. %'              # characters of the numeric stat values
+STAT_LABELS = [ 'CPU: ', 'Load Avg: ', 'Uptime: ', 'CPU Temp: ', 'Mem: ', 'Disk: ' ]
+TEXT_MASKS = {}                             # pre-rendered (mask, width) of drawn text, by (text, font)
 
 
 
@@ -44,28 +113,113 @@ class DisplaySt7789 ():
         dc_pin = digitalio.DigitalInOut(board.D25)
         reset_pin = None
 
+        madctl, y_offset = MADCTL_ROTATIONS[ROTATION]
+
+        spi = board.SPI()
+        match_spi_chunk_size(spi)           # push frames in as few SPI transfers as the kernel allows
+
         # Create the ST7789 display:
         self.display = st7789.ST7789(
-            board.SPI(),
+            spi,
             cs=cs_pin,
             dc=dc_pin,
             rst=reset_pin,
-            baudrate=64000000,              # the pi can be very fast!
-            width=240,                      # width of display
-            height=240,                     # height of display
+            baudrate=get_baudrate(),        # the pi can be very fast!
+            width=WIDTH,
+            height=HEIGHT,
             x_offset=0,
-            y_offset=80,
+            y_offset=y_offset,
         )
+        self.display.write(MADCTL, bytes([madctl]))  # rotate once here, not on every push
 
         self.backlight = digitalio.DigitalInOut(board.D22)
         self.backlight.switch_to_output()
         self.backlight.value = True  # turn on backlight
 
-        self.buttonA = digitalio.DigitalInOut(board.D23)
-        self.buttonB = digitalio.DigitalInOut(board.D24)
-        self.buttonA.switch_to_input()
-        self.buttonB.switch_to_input()
-
+        if (gpiod is not None):
+            chip = gpiod.Chip(GPIO_CHIP)
+            self.buttonA = GpiodButton(chip, BUTTON_A_LINE)
+            self.buttonB = GpiodButton(chip, BUTTON_B_LINE)
+        else:
+            self.buttonA = digitalio.DigitalInOut(board.D23)
+            self.buttonB = digitalio.DigitalInOut(board.D24)
+            self.buttonA.switch_to_input()
+            self.buttonB.switch_to_input()
+
+        # RGB565 shadow of the display contents, big-endian as the st7789 expects it on the wire.
+        # The numpy array is a view of a bytearray, so each push hands SPI a bytearray slice of it:
+        # Adafruit_PureIO copies every write with array.array("B", ...), which is a memcpy for
+        # bytes and bytearrays but iterates any other buffer (memoryview, numpy) element-wise.
+        self.wire = bytearray(WIDTH * HEIGHT * 2)
+        self.framebuf = np.frombuffer(self.wire, dtype='>u2').reshape(HEIGHT, WIDTH)
+        self.shown = False                  # True once framebuf holds what the display shows
+
+        # preallocated buffers, so that a push only allocates PIL's copy of the image pixels:
+        self.backbuf = np.empty((HEIGHT, WIDTH), dtype='>u2')  # next image, packed into RGB565
+        self.pack_hi = np.empty((HEIGHT, WIDTH), dtype=np.uint16)
+        self.pack_lo = np.empty((HEIGHT, WIDTH), dtype=np.uint16)
+        self.diff = np.empty((HEIGHT, WIDTH), dtype=bool)
+        self.row_diff = np.empty(HEIGHT, dtype=bool)
+
+
+    def pack_rgb565 (self, rgb):
+        "Pack the given full size RGB888 pixels into RGB565 in the back buffer."
+        if (PACK565 is not None):           # contiguous pixels in and out, so C can pack them in one pass
+            PACK565(rgb.ctypes.data, self.backbuf.ctypes.data, self.backbuf.size)
+        else:
+            hi, lo = self.pack_hi, self.pack_lo
+            np.bitwise_and(rgb[..., 0], 0xF8, out=hi)
+            np.left_shift(hi, 8, out=hi)
+            np.bitwise_and(rgb[..., 1], 0xFC, out=lo)
+            np.left_shift(lo, 3, out=lo)
+            np.bitwise_or(hi, lo, out=hi)
+            np.right_shift(rgb[..., 2], 3, out=lo)
+            np.bitwise_or(hi, lo, out=hi)
+            self.backbuf[:] = hi            # swaps into the big-endian wire order
+
+    def push_rows (self, y0, y1):
+        "Copy rows y0 through y1 (inclusive) of the back buffer into the frame buffer and push only those rows."
+        self.framebuf[y0:y1 + 1] = self.backbuf[y0:y1 + 1]
+
+        # one write for all the rows: Blinka hands it to Adafruit_PureIO's writebytes, which
+        # sends it in chunk_size transfers (see match_spi_chunk_size and the README)
+        self.display._block(0, y0, WIDTH - 1, y1, self.wire[y0 * WIDTH * 2:(y1 + 1) * WIDTH * 2])
+
+    def show_image (self, image):
+        "Push the given image to the display, sending only the band of rows changed since the last push."
+        self.pack_rgb565(np.asarray(image))  # PIL has no way to expose its RGB pixels without a copy
+        if (not self.shown):
+            y0, y1 = 0, HEIGHT - 1
+            self.shown = True
+        else:
+            # compare as native uint16: equal either way round, and cheaper than big-endian
+            np.not_equal(self.backbuf.view(np.uint16), self.framebuf.view(np.uint16), out=self.diff)
+            np.any(self.diff, axis=1, out=self.row_diff)
+            y0 = int(self.row_diff.argmax())
+            if (not self.row_diff[y0]):     # identical to what is already displayed
+                return
+            y1 = HEIGHT - 1 - int(self.row_diff[::-1].argmax())
+
+        self.push_rows(y0, y1)
+
+    def cleanup (self):
+        "Blank the display, turn off the backlighting, and release the buttons."
+        self.display.fill(0)                # rewrites the whole window, whatever the last push left
+        self.set_backlight(False)
+        self.buttonA.deinit()
+        self.buttonB.deinit()
+
+    def wait_for_edge (self, timeout):
+        """
+        Wait up to the given number of seconds for a button to change. Edge-triggered
+        buttons sleep in select until an edge arrives: polled buttons just sleep briefly.
+        """
+        if (gpiod is not None):
+            ready, _, _ = select.select([self.buttonA, self.buttonB], [], [], timeout)
+            for button in ready:
+                button.read_events()
+        else:
+            time.sleep(min(POLL_TIME, timeout))
 
     def set_backlight (self, on_off=True):
         "Turn the backlighting ON (True) or OFF (False)."
@@ -93,6 +247,40 @@ class DisplaySt7789 ():
 
 
 
+class GpiodButton ():
+    """
+    Class to read a button on an edge-triggered libgpiod line, with the same value and
+    deinit interface as a digitalio input. Its file number can be waited on with select.
+    """
+
+    def __init__(self, chip, offset):
+        """
+        Constructor for class which requests the given line of the given chip for edge events.
+        """
+        super().__init__()
+        self.line = chip.get_line(offset)
+        self.line.request(consumer='pistats', type=GPIOD_BOTH_EDGES)
+
+
+    @property
+    def value (self):
+        "Return the current level of the line: False if the button is depressed."
+        return bool(self.line.get_value())
+
+    def deinit (self):
+        "Release the line."
+        self.line.release()
+
+    def fileno (self):
+        "Return the file descriptor which becomes readable when an edge event arrives."
+        return self.line.event_get_fd()
+
+    def read_events (self):
+        "Read and discard the pending edge events: the line value is what matters."
+        self.line.event_read_multiple()
+
+
+
 def action_or_cancel (disp, draw, image, reboot=True):
     "Give the user a chance to cancel the reboot or shutdown action, otherwise do the action."
     act = 'REBOOT' if (reboot) else 'SHUTDOWN'
@@ -100,20 +288,22 @@ def action_or_cancel (disp, draw, image, reboot=True):
     color = COLORS['green'] if (reboot) else COLORS['yellow']
 
     time.sleep(1)                           # got here too fast: need to let buttons clear!
+    reset_to_black(image)                   # clear the drawing area
+
+    y = TEXT_HEIGHT
+    draw_string(draw, (0, y), f"{act}", font=BIG_FONT, fill=color)
+    y += BIG_TEXT_HEIGHT
+    countdown_y = y                         # only the countdown line is redrawn each second
+    y += 3 * BIG_TEXT_HEIGHT
+    draw_string(draw, (0, y), f"TO CANCEL:", font=BIG_FONT, fill=COLORS['white'])
+    y += BIG_TEXT_HEIGHT
+    draw_string(draw, (0, y), f" hold any button", font=BIG_FONT, fill=COLORS['white'])
+
     for countdown in range(9, 0, -1):
-        reset_to_black(disp, draw)          # clear the drawing area
-
-        y = TEXT_HEIGHT
-        draw.text((0, y), f"{act}", font=BIG_FONT, fill=color)
-        y += BIG_TEXT_HEIGHT
-        draw.text((0, y), f"  in {countdown} seconds!!", font=BIG_FONT, fill=COLORS['aqua'])
-        y += 3 * BIG_TEXT_HEIGHT
-        draw.text((0, y), f"TO CANCEL:", font=BIG_FONT, fill=COLORS['white'])
-        y += BIG_TEXT_HEIGHT
-        draw.text((0, y), f" hold any button", font=BIG_FONT, fill=COLORS['white'])
-        y += 2 * BIG_TEXT_HEIGHT
-
-        disp.display.image(image, ROTATION)
+        clear_line(image, countdown_y, BIG_LINE_HEIGHT)
+        draw_string(draw, (0, countdown_y), f"  in {countdown} seconds!!", font=BIG_FONT, fill=COLORS['aqua'])
+
+        disp.show_image(image)
         time.sleep(1)
 
         if (disp.buttonA_on() or disp.buttonB_on()):  # if either button pressed
@@ -124,77 +314,146 @@ def action_or_cancel (disp, draw, image, reboot=True):
     one_msg(disp, draw, image, msg=act_msg, fill=color)
     flag = '-r' if (reboot) else '-P'
     # print(f"sudo /usr/sbin/shutdown {flag} now --no-wall")
-    os.system(f"sudo /usr/sbin/shutdown {flag} now --no-wall")
+    os.execvp('sudo', ['sudo', '/usr/sbin/shutdown', flag, 'now', '--no-wall'])  # replaces this process
 
 
-def draw_size (disp):
-    "Return the size (width, height) of the drawable area for the given display object."
-    return (disp.display.width - 1, disp.display.height - 1)
+def clear_line (image, y, line_height):
+    "Clear the full width line of text, of the given line height, which was drawn at the given height."
+    image.paste((0, 0, 0), (0, y, WIDTH, y + line_height))
 
 
-def get_stats():
+def draw_stat (draw, y, stat, fill, static=False):
     """
-    Run shell scripts for system monitoring from here and return a list of
-    result strings to be displayed.
-    https://unix.stackexchange.com/questions/119126/command-to-display-memory-usage-disk-usage-and-cpu-load
+    Draw the given stat line at the given height: its label (or the whole line, if static)
+    is pasted from a pre-rendered mask, followed by its value, pasted glyph by glyph.
     """
-    cmd = "hostname"
-    stats = [ "Hostname: " + subprocess.check_output(cmd, shell=True).decode("utf-8") ]
-
-    cmd = "hostname -I | cut -d' ' -f1"
-    stats.append("IP: " + subprocess.check_output(cmd, shell=True).decode("utf-8"))
+    if (static):
+        prefix, value = stat, ''
+    else:
+        label, sep, value = stat.partition(': ')
+        prefix = label + sep
+
+    mask, x = text_mask(prefix, FONT)
+    draw.bitmap((0, y), mask, fill=fill)
+    draw_string(draw, (x, y), value, font=FONT, fill=fill)
+
+
+def draw_string (draw, xy, text, font=FONT, fill='#FFFFFF'):
+    "Draw the given text like draw.text does, but by pasting cached glyph masks one by one."
+    x, y = xy
+    for char in text:
+        mask, width = text_mask(char, font)
+        draw.bitmap((x, y), mask, fill=fill)
+        x += width
+
+
+def get_baudrate ():
+    "Return the SPI clock (in Hz) set by PISTATS_BAUD, or the default if it is unset or invalid."
+    setting = os.environ.get('PISTATS_BAUD')
+    if (setting is None):
+        return DEFAULT_BAUDRATE
+    try:
+        baudrate = int(setting)
+    except ValueError:
+        baudrate = 0
+    if (baudrate <= 0 or baudrate > MAX_BAUDRATE):
+        print(f"Ignoring PISTATS_BAUD={setting!r}: not a clock between 1 and {MAX_BAUDRATE} Hz."
+              f" Using {DEFAULT_BAUDRATE} Hz.", file=sys.stderr)
+        return DEFAULT_BAUDRATE
+    return baudrate
+
+
+def get_ip_address ():
+    "Return the primary IP address of this host, or an empty string if there is no route out."
+    try:
+        # connecting a UDP socket sends no packets but selects the outgoing interface
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect(('8.8.8.8', 80))
+            return sock.getsockname()[0]
+    except OSError:
+        return ''
 
-    cmd = "uptime | awk '{printf \"Load Avg: %.2f\", $(NF-2)}'"
-    stats.append(subprocess.check_output(cmd, shell=True).decode("utf-8"))
 
-    cmd = "uptime | awk '{print $3 \" \" $4}'"
-    stats.append("Uptime: " + subprocess.check_output(cmd, shell=True).decode("utf-8"))
-
-    cmd = "cat /sys/class/thermal/thermal_zone0/temp |  awk '{printf \"CPU Temp: %.1f C\", $(NF-0) / 1000}'"  # pylint: disable=line-too-long
-    stats.append(subprocess.check_output(cmd, shell=True).decode("utf-8"))
+def get_stats():
+    """
+    Return a list of system statistic strings to be displayed. The hostname and IP
+    lines are fixed at startup; each other statistic is only re-read when its cached
+    value is older than its time-to-live.
+    """
+    now = time.monotonic()
+    stats = [ HOSTNAME_LINE, IP_LINE ]
+    for name, reader, ttl in STAT_READERS:
+        cached = STAT_CACHE.get(name)
+        # allow for redraw times wobbling around their deadlines, which are a TTL apart:
+        if (cached is None or now - cached[0] >= ttl - POLL_TIME):
+            cached = (now, reader())
+            STAT_CACHE[name] = cached
+        stats.append(cached[1])
+    return stats
 
-    cmd = "free -m | awk 'NR==2{printf \"Mem: %s/%s MB  %.2f%%\", $3,$2,$3*100/$2 }'"
-    stats.append(subprocess.check_output(cmd, shell=True).decode("utf-8"))
 
-    cmd = 'df -h | awk \'$NF=="/"{printf "Disk: %d/%d GB  %s", $3,$2,$5}\''
-    stats.append(subprocess.check_output(cmd, shell=True).decode("utf-8"))
-    return stats
+def match_spi_chunk_size (spi):
+    """
+    Set the size of the chunks which Blinka's SPI writes are split into (by Adafruit_PureIO's
+    writebytes: 4096 bytes, unless SPI_BUFSIZE is set) to the kernel spidev bufsiz. That is
+    the largest transfer the kernel accepts: any larger chunk fails with EMSGSIZE.
+    """
+    pureio_spi = getattr(getattr(spi, '_spi', None), '_spi', None)
+    if (not hasattr(pureio_spi, 'chunk_size')):
+        return                              # not the Blinka generic Linux SPI: leave it alone
+    try:
+        with open(SPIDEV_BUFSIZ_FILE) as bufsiz_file:
+            pureio_spi.chunk_size = int(bufsiz_file.read())
+    except (OSError, ValueError):
+        print(f"Cannot read {SPIDEV_BUFSIZ_FILE}: leaving the SPI chunk size at"
+              f" {pureio_spi.chunk_size} bytes.", file=sys.stderr)
 
 
 def one_msg (disp, draw, image, msg='', fill='#FFFFFF'):
     "Clear the display and show the single given message, roughly centered."
-    reset_to_black(disp, draw)              # clear the drawing area
+    reset_to_black(image)                   # clear the drawing area
     y = 3 * BIG_TEXT_HEIGHT
-    draw.text((0, y), msg, font=BIG_FONT, fill=fill)
-    disp.display.image(image, ROTATION)
+    draw_string(draw, (0, y), msg, font=BIG_FONT, fill=fill)
+    disp.show_image(image)
     time.sleep(2)
 
 
-def reset_to_black (disp, draw):
-    " Clear the given drawing area by drawing a black rectangle."
-    dwidth, dheight = draw_size(disp)
-    draw.rectangle((0, 0, dwidth, dheight), outline=(0, 0, 0), fill=(0, 0, 0))
+def read_stat_file (path):
+    "Return the current contents of the given /proc or /sys file, which is kept open for rereading."
+    stat_file = STAT_FILES.get(path)
+    if (stat_file is None):
+        stat_file = open(path)
+        STAT_FILES[path] = stat_file
+    stat_file.seek(0)                       # proc/sys files regenerate their contents on reread
+    return stat_file.read()
+
+
+def reset_to_black (image):
+    " Clear the given drawing area by pasting a black image over it."
+    image.paste(BLACK_IMAGE, (0, 0))
 
 
 def restart_menu (disp, image, draw):
     "Show the reboot/shutdown menu for a limited time; dispatch an action or timeout."
-    for countdown in range(10, 0, -1):
-        reset_to_black(disp, draw)          # clear the drawing area
+    reset_to_black(image)                   # clear the drawing area
 
-        y = TEXT_HEIGHT
-        draw.text((0, y), f"to REBOOT:", font=BIG_FONT, fill=COLORS['green'])
-        y += BIG_TEXT_HEIGHT
-        draw.text((0, y), f"   hold button A", font=FONT, fill=COLORS['white'])
-        y += 2 * TEXT_HEIGHT
+    y = TEXT_HEIGHT
+    draw_string(draw, (0, y), f"to REBOOT:", font=BIG_FONT, fill=COLORS['green'])
+    y += BIG_TEXT_HEIGHT
+    draw_string(draw, (0, y), f"   hold button A", font=FONT, fill=COLORS['white'])
+    y += 2 * TEXT_HEIGHT
 
-        draw.text((0, y), f"to SHUTDOWN:", font=BIG_FONT, fill=COLORS['yellow'])
-        y += BIG_TEXT_HEIGHT
-        draw.text((0, y), f"   hold button B", font=FONT, fill=COLORS['white'])
-        y += 2 * TEXT_HEIGHT
+    draw_string(draw, (0, y), f"to SHUTDOWN:", font=BIG_FONT, fill=COLORS['yellow'])
+    y += BIG_TEXT_HEIGHT
+    draw_string(draw, (0, y), f"   hold button B", font=FONT, fill=COLORS['white'])
+    y += 2 * TEXT_HEIGHT
 
-        draw.text((0, y), f"Times out in:", font=BIG_FONT, fill=COLORS['red'])
-        y += BIG_TEXT_HEIGHT
-        draw.text((0, y), f"   {countdown} seconds", font=BIG_FONT, fill=COLORS['pink'])
+    draw_string(draw, (0, y), f"Times out in:", font=BIG_FONT, fill=COLORS['red'])
+    y += BIG_TEXT_HEIGHT
+
+    for countdown in range(10, 0, -1):
+        clear_line(image, y, BIG_LINE_HEIGHT)  # only the countdown line is redrawn each second
+        draw_string(draw, (0, y), f"   {countdown} seconds", font=BIG_FONT, fill=COLORS['pink'])
 
         if (disp.buttonA_on() and disp.buttonB_off()):  # just button A pressed
             action_or_cancel(disp, draw, image, True)   # true => reboot
@@ -204,46 +463,161 @@ def restart_menu (disp, image, draw):
             action_or_cancel(disp, draw, image, False)    # false => shutdown
             break
 
-        disp.display.image(image, ROTATION)
+        disp.show_image(image)
         time.sleep(1)
 
 
-def main (argv=None):
-    disp = DisplaySt7789()
-    dwidth, dheight = draw_size(disp)
+def stat_cpu ():
+    "Return the display string for the CPU usage since the last call, from the /proc/stat counters."
+    global CPU_TIMES
+    times = [ int(field) for field in read_stat_file('/proc/stat').split('\n', 1)[0].split()[1:9] ]
+    total = sum(times)
+    busy = total - times[3] - times[4]      # all but idle and iowait
+    last_busy, last_total = CPU_TIMES
+    CPU_TIMES = (busy, total)
+    cpu_pct = 100 * (busy - last_busy) / max(total - last_total, 1)
+    return f"CPU: {cpu_pct:.0f}%"
+
+
+def stat_disk ():
+    "Return the display string for disk usage of the root filesystem."
+    fs = os.statvfs('/')
+    disk_total = fs.f_blocks * fs.f_frsize
+    disk_used = (fs.f_blocks - fs.f_bfree) * fs.f_frsize
+    disk_avail = fs.f_bavail * fs.f_frsize
+    disk_pct = math.ceil(disk_used * 100 / (disk_used + disk_avail))  # all rounded up, like df
+    return f"Disk: {math.ceil(disk_used / GIGABYTE)}/{math.ceil(disk_total / GIGABYTE)} GB  {disk_pct}%"
+
+
+def stat_load ():
+    "Return the display string for the 1 minute load average."
+    load_avg = float(read_stat_file('/proc/loadavg').split()[0])
+    return f"Load Avg: {load_avg:.2f}"
+
+
+def stat_mem ():
+    "Return the display string for memory usage."
+    meminfo = dict(line.split()[:2] for line in read_stat_file('/proc/meminfo').splitlines())
+    mem_total = int(meminfo['MemTotal:']) // 1024
+    mem_used = mem_total - int(meminfo['MemAvailable:']) // 1024
+    return f"Mem: {mem_used}/{mem_total} MB  {mem_used * 100 / mem_total:.2f}%"
+
+
+def stat_temp ():
+    "Return the display string for the CPU temperature, or a placeholder if there is no sensor."
+    try:
+        temp = int(read_stat_file('/sys/class/thermal/thermal_zone0/temp')) / 1000
+    except OSError:
+        return "CPU Temp: n/a"
+    return f"CPU Temp: {temp:.1f} C"
+
+
+def stat_uptime ():
+    "Return the display string for the system uptime, in days, hours, and minutes."
+    up_mins = int(float(read_stat_file('/proc/uptime').split()[0])) // 60
+    up_days, up_mins = divmod(up_mins, 24 * 60)
+    up_hours, up_mins = divmod(up_mins, 60)
+    day_str = f"{up_days}d " if (up_days) else ''
+    return f"Uptime: {day_str}{up_hours}:{up_mins:02d}"
+
+
+# Changing statistics to display, in order: (cache key, reader function, time-to-live in seconds)
+STAT_READERS = [
+    ('cpu', stat_cpu, 1),
+    ('load', stat_load, 1),
+    ('uptime', stat_uptime, 1),
+    ('temp', stat_temp, 1),
+    ('mem', stat_mem, 1),
+    ('disk', stat_disk, 30),
+]
+
+
+def text_mask (text, font):
+    "Return a (mask, width) pair for the given text in the given font, rendering it on first use."
+    key = (text, font)
+    cached = TEXT_MASKS.get(key)
+    if (cached is None):
+        width, height = font.getsize(text)
+        mask = Image.new('L', (max(width, 1), max(height, 1)))
+        ImageDraw.Draw(mask).text((0, 0), text, font=font, fill=255)
+        cached = (mask, width)
+        TEXT_MASKS[key] = cached
+    return cached
+
+
+def wait_for_change (disp, btn_a, btn_b, deadline, period):
+    """
+    Sleep until the given deadline, watching the buttons and returning early if either one
+    changes from the given state. Return the deadline for the next wait: the same one after
+    an early return, otherwise one period later (or one period from now, if running late).
+    """
+    while True:
+        now = time.monotonic()
+        if (now >= deadline):
+            deadline += period
+            return deadline if (deadline > now) else now + period
+        disp.wait_for_edge(deadline - now)
+        if (disp.buttonA_on() != btn_a or disp.buttonB_on() != btn_b):
+            return deadline
 
-    image = Image.new('RGB', (disp.display.width, disp.display.height))
-    draw = ImageDraw.Draw(image)
 
-    sleep_time = 1                          # time to sleep (in seconds) in each iteration
+def exit_on_signal (signum, frame):
+    "Exit through the normal cleanup path when a signal (e.g. SIGTERM from systemd) arrives."
+    sys.exit(0)
 
-    # Main loop:
-    while True:
-        reset_to_black(disp, draw)          # clear the drawing area
 
-        y = 0
-        stats = get_stats()
-        if (stats):
-            fill_colors = list(COLORS.values())
-            for ndx, stat in enumerate(stats):
-                fill_color = fill_colors[ndx % len(fill_colors)]
-                draw.text((0, y), stat, font=FONT, fill=fill_color)
-                y += TEXT_HEIGHT
+def main (argv=None):
+    global HOSTNAME_LINE, IP_LINE
+    HOSTNAME_LINE = f"Hostname: {socket.gethostname()}"
+    IP_LINE = f"IP: {get_ip_address()}"
+    for text in (HOSTNAME_LINE, IP_LINE, *STAT_LABELS, *GLYPH_CHARS):
+        text_mask(text, FONT)               # pre-render the text which is drawn every tick
 
-        if (disp.buttonA_on() and disp.buttonB_off()):  # just button A pressed
-            draw.text((0, y), f"Btns: A=ON, B=OFF", font=FONT, fill=COLORS['white'])
+    disp = DisplaySt7789()
 
-        elif (disp.buttonB_on() and disp.buttonA_off()):  # just button B pressed
-            draw.text((0, y), f"Btns: A=OFF, B=ON", font=FONT, fill=COLORS['white'])
+    image = Image.new('RGB', (WIDTH, HEIGHT))
+    draw = ImageDraw.Draw(image)
 
-        elif (disp.buttonB_on() and disp.buttonA_on()):   # both on
-            restart_menu(disp, image, draw)
+    sleep_time = 1                          # time to sleep (in seconds) in each iteration
+    last_frame = None                       # the stats and button states last shown on the display
+    next_draw = time.monotonic()            # deadline for the next scheduled redraw
 
-        else:
-            draw.text((0, y), f"Btns: both OFF", font=FONT, fill=COLORS['red'])
+    signal.signal(signal.SIGTERM, exit_on_signal)
 
-        disp.display.image(image, ROTATION)
-        time.sleep(sleep_time)
+    # Main loop:
+    try:
+        while True:
+            stats = get_stats()
+            btn_a = disp.buttonA_on()
+            btn_b = disp.buttonB_on()
+            state = (int(btn_a) << 1) | int(btn_b)
+
+            frame = (tuple(stats), state)
+            if (frame == last_frame):       # nothing visible has changed: skip the redraw
+                next_draw = wait_for_change(disp, btn_a, btn_b, next_draw, sleep_time)
+                continue
+
+            reset_to_black(image)           # clear the drawing area
+
+            y = 0
+            if (stats):
+                for ndx, stat in enumerate(stats):
+                    fill_color = FILL_COLORS[ndx % len(FILL_COLORS)]
+                    draw_stat(draw, y, stat, fill_color, static=(ndx < 2))  # hostname and IP never change
+                    y += TEXT_HEIGHT
+
+            if (state == BOTH_BUTTONS):     # both on
+                restart_menu(disp, image, draw)
+                frame = None                # the menu overwrote the display: redraw next time
+            else:
+                label, color = BUTTON_LABELS[state]
+                draw_string(draw, (0, y), label, font=FONT, fill=color)
+
+            disp.show_image(image)
+            last_frame = frame
+            next_draw = wait_for_change(disp, btn_a, btn_b, next_draw, sleep_time)
+    finally:
+        disp.cleanup()
 
 
 